@@ -2,15 +2,23 @@
 """FastAPI application (shared between Modal and local)"""
 import uuid
 import os
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
-import asyncio
-import json
+from functools import lru_cache
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+import orjson
+import time
 
 from rs_common_interfaces_py import RsVideoCodec, RsVideoFormat, VideoConvertJob
 from .storage import StorageBackend
 
 
+@lru_cache(maxsize=64)
+def _mime_for_ext(ext: str) -> str:
+    """MIME type for a file extension (cached, there are only a handful)"""
+    return RsVideoFormat.from_filename(f"x{ext}").as_mime()
+
+
 def create_app(storage: StorageBackend, worker_func) -> FastAPI:
     """Create FastAPI app with injected storage and worker"""
     
@@ -22,7 +30,11 @@ def create_app(storage: StorageBackend, worker_func) -> FastAPI:
             raise HTTPException(status_code=400, detail="Missing 'url'")
         
         job_id = str(uuid.uuid4())
-        storage.set_state(job_id, {
+        await storage.set_record_async(job_id, {
+            "source_url": job.source.url,
+            "created_at": time.time(),
+        })
+        await storage.set_state_async(job_id, {
             "status": "queued",
             "progress": 0,
             "message": "Queued"
@@ -35,14 +47,14 @@ def create_app(storage: StorageBackend, worker_func) -> FastAPI:
     
     @api.get("/status/{job_id}")
     async def status(job_id: str):
-        data = storage.get_state(job_id)
+        data = await storage.get_state_async(job_id)
         if not data:
             raise HTTPException(status_code=404, detail="Unknown job_id")
         return data
     
     @api.get("/download/{job_id}")
-    async def download(job_id: str):
-        data = storage.get_state(job_id)
+    async def download(job_id: str, request: Request):
+        data = await storage.get_state_async(job_id)
         if not data or data.get("status") != "completed":
             raise HTTPException(status_code=404, detail="Not ready")
         
@@ -52,32 +64,42 @@ def create_app(storage: StorageBackend, worker_func) -> FastAPI:
         if not path or not storage.file_exists(path):
             raise HTTPException(status_code=404, detail="File missing")
         
-        def file_iter():
-            with open(path, "rb") as f:
-                while True:
-                    chunk = f.read(1024 * 1024)
-                    if not chunk:
-                        break
-                    yield chunk
-        mime = RsVideoFormat.from_filename(name).as_mime()
-        headers = {"Content-Disposition": f"attachment; filename={name}"}
-        return StreamingResponse(file_iter(), media_type=mime, headers=headers)
+        mime = _mime_for_ext(os.path.splitext(name)[1])
+        # FileResponse lets the server use sendfile(2) and answers Range requests.
+        # The file is kept: the server can't tell an interrupted transfer from a
+        # finished one, so removal is left to the cleanup job, which drops
+        # downloaded files after a short grace period for resumes
+        background = None
+        if "range" not in request.headers:
+            background = BackgroundTask(mark_downloaded_task, job_id)
+        return FileResponse(
+            path,
+            media_type=mime,
+            filename=name,
+            background=background,
+        )
+    
+    async def mark_downloaded_task(job_id: str):
+        """Flag a job as downloaded"""
+        await storage.set_record_async(job_id, {
+            "downloaded": True,
+            "downloaded_at": time.time(),
+        })
     
     @api.get("/progress/{job_id}/events")
     async def sse_progress(job_id: str):
         async def event_gen():
-            sent_done = False
-            while True:
-                data = storage.get_state(job_id) or {"status": "unknown", "progress": 0}
-                payload = json.dumps(data)
+            async for data in storage.watch(job_id):
+                if data is None:
+                    # SSE comment, keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                
+                payload = orjson.dumps(data).decode()
                 yield f"data: {payload}\n\n"
                 
                 if data.get("status") in ("completed", "failed"):
-                    if sent_done:
-                        break
-                    sent_done = True
-                
-                await asyncio.sleep(1)
+                    break
         
         return StreamingResponse(event_gen(), media_type="text/event-stream")
     
@@ -1,24 +1,36 @@
 # core/storage.py
 """Storage abstraction for Modal and local environments"""
 from abc import ABC, abstractmethod
-from typing import Optional, Dict, Any, Iterator
+from typing import Optional, Dict, Any, Iterator, AsyncIterator, Tuple
+import asyncio
 import os
-import json
+import queue
+import orjson
+import time
 import tempfile
 from pathlib import Path
 
 
+# Fields rewritten on every progress tick, everything else belongs to the job record
+PROGRESS_FIELDS = ("status", "progress", "message")
+
+
 class StorageBackend(ABC):
     """Abstract storage for state and files"""
     
     @abstractmethod
     def get_state(self, job_id: str) -> Optional[Dict[str, Any]]:
-        """Get job state"""
+        """Get job state (record merged with progress)"""
         pass
     
     @abstractmethod
     def set_state(self, job_id: str, data: Dict[str, Any]):
-        """Set job state"""
+        """Set job progress (status, progress, message)"""
+        pass
+    
+    @abstractmethod
+    def set_record(self, job_id: str, data: Dict[str, Any]):
+        """Merge fields into the job record (written rarely)"""
         pass
     
     @abstractmethod
@@ -45,6 +57,27 @@ class StorageBackend(ABC):
     def commit(self):
         """Commit changes (no-op for local)"""
         pass
+    
+    async def get_state_async(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """get_state without blocking the event loop"""
+        return await asyncio.to_thread(self.get_state, job_id)
+    
+    async def set_state_async(self, job_id: str, data: Dict[str, Any]):
+        """set_state without blocking the event loop"""
+        await asyncio.to_thread(self.set_state, job_id, data)
+    
+    async def set_record_async(self, job_id: str, data: Dict[str, Any]):
+        """set_record without blocking the event loop"""
+        await asyncio.to_thread(self.set_record, job_id, data)
+    
+    async def watch(self, job_id: str) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """Yield job state updates, or None when nothing changed for a while
+        
+        Polls every second by default.
+        """
+        while True:
+            yield self.get_state(job_id) or {"status": "unknown", "progress": 0}
+            await asyncio.sleep(1)
 
 
 class LocalStorage(StorageBackend):
@@ -53,23 +86,39 @@ class LocalStorage(StorageBackend):
     def __init__(self, base_dir: str = "./data"):
         self.base_dir = Path(base_dir)
         self.state_dir = self.base_dir / "state"
+        self.records_dir = self.base_dir / "records"
         self.files_dir = self.base_dir / "files"
         self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.records_dir.mkdir(parents=True, exist_ok=True)
         self.files_dir.mkdir(parents=True, exist_ok=True)
     
+    def _read(self, path: Path) -> Optional[Dict[str, Any]]:
+        if not path.exists():
+            return None
+        return orjson.loads(path.read_bytes())
+    
     def get_state(self, job_id: str) -> Optional[Dict[str, Any]]:
-        state_file = self.state_dir / f"{job_id}.json"
-        if not state_file.exists():
+        record = self._read(self.records_dir / f"{job_id}.json")
+        progress = self._read(self.state_dir / f"{job_id}.json")
+        if record is None and progress is None:
             return None
-        return json.loads(state_file.read_text())
+        return {**(record or {}), **(progress or {})}
     
     def set_state(self, job_id: str, data: Dict[str, Any]):
         state_file = self.state_dir / f"{job_id}.json"
-        state_file.write_text(json.dumps(data))
+        state_file.write_bytes(orjson.dumps(data))
+    
+    def set_record(self, job_id: str, data: Dict[str, Any]):
+        record_file = self.records_dir / f"{job_id}.json"
+        record = self._read(record_file) or {}
+        record.update(data)
+        record_file.write_bytes(orjson.dumps(record))
     
     def list_jobs(self) -> Iterator[str]:
-        for f in self.state_dir.glob("*.json"):
-            yield f.stem
+        with os.scandir(self.state_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".json") and entry.is_file():
+                    yield entry.name[:-5]
     
     def get_file_path(self, job_id: str, filename: str) -> str:
         job_dir = self.files_dir / job_id
@@ -92,21 +141,192 @@ class LocalStorage(StorageBackend):
 
 
 class ModalStorage(StorageBackend):
-    """Modal Dict + Volume storage"""
+    """Modal Dict + Volume storage, with optional Queue for pushing updates
+    
+    Each job uses two Dict keys: a small "prog:" entry rewritten on every
+    progress tick and a "job:" record written at submit/completion/cleanup.
+    An optional second Dict indexes the records of completed jobs whose file
+    is still on the volume, so cleanup doesn't scan the whole job history.
+    """
+    
+    RECORD_PREFIX = "job:"
+    PROGRESS_PREFIX = "prog:"
+    # Set once the pre-split bare job_id entries have been migrated
+    SCHEMA_KEY = "meta:schema"
+    SCHEMA_VERSION = 2
+    
+    # Seconds between Dict re-reads when no pushed update arrives. Another API
+    # container may consume a job's pushes, so this bounds how late they show up
+    WATCH_POLL_S = 1
+    # Seconds without a change before a watcher yields a keepalive
+    WATCH_TIMEOUT = 15
+    # Seconds a state read from the Dict is served from memory
+    STATE_CACHE_TTL = 0.5
+    # Cached keys before expired entries are swept out
+    STATE_CACHE_SIZE = 1024
+    # Records per Dict.update call (and concurrent RPCs for bulk removals),
+    # keeps each request well under Modal's size limit
+    BATCH_SIZE = 100
     
-    def __init__(self, dict_obj, volume_obj, volume_path: str = "/vol"):
+    def __init__(self, dict_obj, volume_obj, volume_path: str = "/vol", queue_obj=None, pending_obj=None):
         self.dict = dict_obj
         self.volume = volume_obj
         self.volume_path = volume_path
+        self.queue = queue_obj
+        self.pending = pending_obj
+        self._feeds: Dict[str, _JobFeed] = {}
+        self._cache: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}
     
-    def get_state(self, job_id: str) -> Optional[Dict[str, Any]]:
-        return self.dict.get(job_id)
+    def _get(self, key: str, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if use_cache and cached and now - cached[0] < self.STATE_CACHE_TTL:
+            return cached[1]
+        data = self.dict.get(key)
+        self._remember(key, data, now)
+        return data
+    
+    def _put(self, key: str, data: Dict[str, Any]):
+        self.dict[key] = data
+        self._remember(key, dict(data), time.monotonic())
+    
+    def _remember(self, key: str, data: Optional[Dict[str, Any]], now: float):
+        self._cache[key] = (now, data)
+        if len(self._cache) > self.STATE_CACHE_SIZE:
+            # Entries are useless once expired, drop them all in one pass
+            self._cache = {k: v for k, v in self._cache.items() if now - v[0] < self.STATE_CACHE_TTL}
+    
+    def get_state(self, job_id: str, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        record = self._get(self.RECORD_PREFIX + job_id, use_cache)
+        progress = self._get(self.PROGRESS_PREFIX + job_id, use_cache)
+        if record is None and progress is None:
+            # Jobs written before the record/progress split, until migrate() runs
+            legacy = self._get(job_id, use_cache)
+            return dict(legacy) if legacy is not None else None
+        # Always a fresh dict, callers may mutate it
+        return {**(record or {}), **(progress or {})}
     
     def set_state(self, job_id: str, data: Dict[str, Any]):
-        self.dict[job_id] = data
+        self._put(self.PROGRESS_PREFIX + job_id, data)
+        if self.queue is not None:
+            try:
+                # One partition per job, never block the writer on a full partition
+                self.queue.put(data, block=False, partition=job_id)
+            except queue.Full:
+                pass
+    
+    def set_record(self, job_id: str, data: Dict[str, Any]):
+        key = self.RECORD_PREFIX + job_id
+        record = dict(self._get(key, use_cache=False) or {})
+        record.update(data)
+        self._put(key, record)
+        
+        if data.get("deleted"):
+            self._forget(job_id)
+        elif self.pending is not None and ("file_path" in data or "downloaded" in data):
+            self.pending[job_id] = record
+    
+    def _forget(self, job_id: str):
+        """Drop a finished job from the cleanup index and its update partition"""
+        if self.pending is not None:
+            self.pending.pop(job_id, None)
+        if self.queue is not None:
+            self.queue.clear(partition=job_id)
+    
+    def _is_legacy(self, key: str) -> bool:
+        return not key.startswith((self.RECORD_PREFIX, self.PROGRESS_PREFIX, "meta:"))
     
     def list_jobs(self) -> Iterator[str]:
-        return iter(self.dict.keys())
+        for key in self.dict.keys():
+            if key.startswith(self.PROGRESS_PREFIX):
+                yield key[len(self.PROGRESS_PREFIX):]
+            elif self._is_legacy(key):
+                yield key
+    
+    async def _scan(self) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        """Read the whole Dict once, returns (merged states, legacy entries) by job_id"""
+        records: Dict[str, Dict[str, Any]] = {}
+        progress: Dict[str, Dict[str, Any]] = {}
+        legacy: Dict[str, Dict[str, Any]] = {}
+        async for key, data in self.dict.items.aio():
+            if key.startswith(self.RECORD_PREFIX):
+                records[key[len(self.RECORD_PREFIX):]] = data
+            elif key.startswith(self.PROGRESS_PREFIX):
+                progress[key[len(self.PROGRESS_PREFIX):]] = data
+            elif self._is_legacy(key):
+                legacy[key] = data
+        states = {
+            job_id: {**legacy.get(job_id, {}), **records.get(job_id, {}), **progress.get(job_id, {})}
+            for job_id in records.keys() | progress.keys() | legacy.keys()
+        }
+        return states, legacy
+    
+    async def iter_states(self) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """Stream every (job_id, state) pair from one Dict scan (uncached)"""
+        states, _ = await self._scan()
+        for job_id, data in states.items():
+            yield job_id, data
+    
+    async def migrate(self):
+        """One-off move of bare job_id entries to job:/prog: keys and backfill of the pending index"""
+        if await self.dict.get.aio(self.SCHEMA_KEY) == self.SCHEMA_VERSION:
+            return
+        
+        states, legacy = await self._scan()
+        moved: Dict[str, Any] = {}
+        pending: Dict[str, Dict[str, Any]] = {}
+        for job_id, data in states.items():
+            if job_id in legacy:
+                moved[self.RECORD_PREFIX + job_id] = {k: v for k, v in data.items() if k not in PROGRESS_FIELDS}
+                moved[self.PROGRESS_PREFIX + job_id] = {k: data[k] for k in PROGRESS_FIELDS if k in data}
+            if data.get("status") == "completed" and data.get("file_path") and not data.get("deleted"):
+                pending[job_id] = {k: v for k, v in data.items() if k not in PROGRESS_FIELDS}
+        
+        items = list(moved.items())
+        for i in range(0, len(items), self.BATCH_SIZE):
+            await self.dict.update.aio(dict(items[i:i + self.BATCH_SIZE]))
+        keys = list(legacy)
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            await asyncio.gather(*(self.dict.pop.aio(key, None) for key in keys[i:i + self.BATCH_SIZE]))
+        if self.pending is not None:
+            items = list(pending.items())
+            for i in range(0, len(items), self.BATCH_SIZE):
+                await self.pending.update.aio(dict(items[i:i + self.BATCH_SIZE]))
+        
+        await self.dict.put.aio(self.SCHEMA_KEY, self.SCHEMA_VERSION)
+        print(f"Migrated {len(legacy)} legacy jobs, indexed {len(pending)} pending files")
+    
+    async def iter_pending(self) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """Stream (job_id, record) for completed jobs whose file wasn't removed yet"""
+        if self.pending is None:
+            async for job_id, data in self.iter_states():
+                if data.get("status") == "completed" and not data.get("deleted"):
+                    yield job_id, data
+            return
+        
+        async for job_id, data in self.pending.items.aio():
+            yield job_id, data
+    
+    async def set_records(self, states: Dict[str, Dict[str, Any]]):
+        """Write the record part of many full states, one Dict.update per BATCH_SIZE jobs"""
+        items = [
+            (self.RECORD_PREFIX + job_id, {k: v for k, v in data.items() if k not in PROGRESS_FIELDS})
+            for job_id, data in states.items()
+        ]
+        for i in range(0, len(items), self.BATCH_SIZE):
+            await self.dict.update.aio(dict(items[i:i + self.BATCH_SIZE]))
+        now = time.monotonic()
+        for key, data in items:
+            self._remember(key, data, now)
+        
+        # Deleted files no longer need cleaning up or watching
+        done = [job_id for job_id, data in states.items() if data.get("deleted")]
+        for i in range(0, len(done), self.BATCH_SIZE):
+            batch = done[i:i + self.BATCH_SIZE]
+            if self.pending is not None:
+                await asyncio.gather(*(self.pending.pop.aio(job_id, None) for job_id in batch))
+            if self.queue is not None:
+                await asyncio.gather(*(self.queue.clear.aio(partition=job_id) for job_id in batch))
     
     def get_file_path(self, job_id: str, filename: str) -> str:
         job_dir = f"{self.volume_path}/{job_id}"
@@ -125,3 +345,135 @@ class ModalStorage(StorageBackend):
     
     def commit(self):
         self.volume.commit()
+    
+    async def _aget(self, key: str, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if use_cache and cached and now - cached[0] < self.STATE_CACHE_TTL:
+            return cached[1]
+        data: Optional[Dict[str, Any]] = await self.dict.get.aio(key)
+        self._remember(key, data, now)
+        return data
+    
+    async def get_state_async(self, job_id: str, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        """get_state without blocking the event loop"""
+        record, progress = await asyncio.gather(
+            self._aget(self.RECORD_PREFIX + job_id, use_cache),
+            self._aget(self.PROGRESS_PREFIX + job_id, use_cache),
+        )
+        if record is None and progress is None:
+            legacy = await self._aget(job_id, use_cache)
+            return dict(legacy) if legacy is not None else None
+        return {**(record or {}), **(progress or {})}
+    
+    async def set_state_async(self, job_id: str, data: Dict[str, Any]):
+        key = self.PROGRESS_PREFIX + job_id
+        await self.dict.put.aio(key, data)
+        self._remember(key, dict(data), time.monotonic())
+        if self.queue is not None:
+            try:
+                await self.queue.put.aio(data, block=False, partition=job_id)
+            except queue.Full:
+                pass
+    
+    async def set_record_async(self, job_id: str, data: Dict[str, Any]):
+        key = self.RECORD_PREFIX + job_id
+        record = dict(await self._aget(key, use_cache=False) or {})
+        record.update(data)
+        await self.dict.put.aio(key, record)
+        self._remember(key, dict(record), time.monotonic())
+        
+        if data.get("deleted"):
+            if self.pending is not None:
+                await self.pending.pop.aio(job_id, None)
+            if self.queue is not None:
+                await self.queue.clear.aio(partition=job_id)
+        elif self.pending is not None and ("file_path" in data or "downloaded" in data):
+            await self.pending.put.aio(job_id, record)
+    
+    def _subscribe(self, job_id: str) -> "_JobFeed":
+        feed = self._feeds.get(job_id)
+        if feed is None:
+            feed = self._feeds[job_id] = _JobFeed()
+            feed.task = asyncio.create_task(self._pump(job_id, feed))
+        feed.subscribers += 1
+        return feed
+    
+    def _unsubscribe(self, job_id: str, feed: "_JobFeed"):
+        feed.subscribers -= 1
+        if feed.subscribers == 0:
+            del self._feeds[job_id]
+            if feed.task:
+                feed.task.cancel()
+    
+    async def _pump(self, job_id: str, feed: "_JobFeed"):
+        """Sole consumer of a job's partition in this process, wakes every watcher"""
+        assert self.queue is not None
+        while True:
+            try:
+                # Items only hint at a change, watchers re-read the merged state
+                await self.queue.get_many.aio(1000, partition=job_id, timeout=self.WATCH_POLL_S)
+            except queue.Empty:
+                # Also wake up on timeout, for pushes taken by another container
+                # or dropped while the partition was full
+                pass
+            except Exception as e:
+                print(f"Progress queue read failed: {e}")
+                await asyncio.sleep(1)
+            await feed.notify()
+    
+    async def watch(self, job_id: str) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """Yield the merged job state on every pushed update
+        
+        Reading a Queue partition consumes it, so a single pump per job feeds all
+        watchers in this process, and the Dict is re-read every WATCH_POLL_S in
+        case a push went to another container.
+        """
+        if self.queue is None:
+            async for data in super().watch(job_id):
+                yield data
+            return
+        
+        feed = self._subscribe(job_id)
+        try:
+            last = None
+            last_yield = 0.0
+            while True:
+                # Taken before the read, so a wake-up arriving during it isn't lost
+                seen = feed.version
+                # Uncached: the worker writes from another process, only the Dict
+                # has its latest state
+                data = await self.get_state_async(job_id, use_cache=False)
+                now = time.monotonic()
+                if data is not None and data == last:
+                    if now - last_yield >= self.WATCH_TIMEOUT:
+                        # Nothing new for a while, just signal we're alive
+                        last_yield = now
+                        yield None
+                else:
+                    last = data
+                    last_yield = now
+                    yield data or {"status": "unknown", "progress": 0}
+                await feed.wait(seen)
+        finally:
+            self._unsubscribe(job_id, feed)
+
+
+class _JobFeed:
+    """Change notifications for one job, shared by its watchers"""
+    
+    def __init__(self):
+        self.version = 0
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Condition()
+    
+    async def notify(self):
+        async with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+    
+    async def wait(self, seen: int):
+        """Wait until an update newer than version seen"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.version != seen)
@@ -1,26 +1,42 @@
 # core/worker.py
 """Core transcoding logic (shared between Modal and local)"""
+import asyncio
+import importlib.util
+import json
+import os
+import shutil
+import signal
 import subprocess
-import tempfile
-import time
+import re
 import shlex
-from typing import Optional
-import requests
+import time
+from contextlib import aclosing
+from functools import cache
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, List, Optional, Tuple
+import aiohttp
 
-from rs_common_interfaces_py import VideoConvertJob, RsVideoCodec
+from rs_common_interfaces_py import VideoConvertJob, RsVideoCodec, RsRequest, header_value
 from .storage import StorageBackend
 
 
-def transcode_video(
+# Encodes (segment, output) pairs in parallel, yielding each success flag as it finishes
+SegmentEncoder = Callable[[VideoConvertJob, List[Tuple[str, str]], list], AsyncIterator[bool]]
+
+
+async def transcode_video(
     job_id: str,
     job: VideoConvertJob,
     storage: StorageBackend,
-    use_gpu: bool = True
+    use_gpu: bool = True,
+    info: Optional[dict] = None
 ):
-    """Core transcoding function - works locally or on Modal"""
+    """Core transcoding function - works locally or on Modal
+    
+    info is a probe() result already taken by the caller, if any.
+    """
     
     # Update state
-    storage.set_state(job_id, {
+    await storage.set_state_async(job_id, {
         "status": "downloading",
         "progress": 0,
         "message": "Downloading source"
@@ -33,180 +49,947 @@ def transcode_video(
     print(f"Starting job {job_id}")
     print(f"Format: {job.request.format}, Codec: {job.request.codec}, CRF: {job.request.crf}")
     
-    with tempfile.TemporaryDirectory() as tmp:
-        # Download source
-        src = f"{tmp}/input"
-        with requests.get(job.source.url, stream=True, timeout=60) as r:
-            r.raise_for_status()
-            with open(src, "wb") as f:
-                for chunk in r.iter_content(1 << 20):
-                    if chunk:
-                        f.write(chunk)
-        
-        # Probe duration
-        duration_s = probe_duration(src)
-        
-        # Get output path
-        dst = storage.get_file_path(job_id, f"output{job.request.format.to_extension()}")
-        
+    # FFmpeg reads plain GET sources itself, anything else is piped through stdin
+    piped = needs_pipe(job.source)
+    src = PIPE_INPUT if piped else job.source.url
+    
+    # Probe once for duration, codecs, pixel format and size (needs a URL
+    # ffprobe can request on its own)
+    if info is None:
+        info = {}
+        if not piped:
+            info = await asyncio.to_thread(probe, src, source_headers(job.source))
+    duration_s = probed_duration(info)
+    streams = info.get("streams", [])
+    
+    # Get output path
+    dst = storage.get_file_path(job_id, f"output{job.request.format.to_extension()}")
+    
+    success = False
+    if use_gpu and can_use_pynv(job, src, streams):
+        success = await transcode_pynv(job_id, job, src, dst, streams, duration_s, storage)
+        if not success:
+            print("PyNvVideoCodec encode failed, falling back to FFmpeg")
+    
+    if not success:
         # Build FFmpeg command
-        cmd = build_ffmpeg_command(job, src, dst, use_gpu)
+        # Checked on a thread, the first call runs ffmpeg -h
+        uhq = use_gpu and await asyncio.to_thread(av1_nvenc_has_uhq)
+        cmd = build_ffmpeg_command(job, src, dst, use_gpu, streams, uhq)
         
         print("FFmpeg command:", " ".join(shlex.quote(arg) for arg in cmd))
         
         # Update state
-        storage.set_state(job_id, {
+        await storage.set_state_async(job_id, {
             "status": "encoding",
             "progress": 0,
             "message": "Encoding started"
         })
         
-        # Run FFmpeg
-        success = run_ffmpeg_with_progress(cmd, duration_s, job_id, storage)
-        
-        if success:
-            storage.set_state(job_id, {
-                "status": "completed",
-                "progress": 100,
-                "message": "Done",
-                "file_path": dst,
-                "file_name": f"output{job.request.format.to_extension()}",
-            })
-        else:
-            storage.set_state(job_id, {
-                "status": "failed",
-                "progress": 0,
-                "message": "Encoding failed",
-            })
+        # Run FFmpeg (network read overlaps encoding)
+        success = await run_ffmpeg_with_progress(
+            cmd, duration_s, job_id, storage, source=job.source if piped else None
+        )
+    
+    if success:
+        await complete_job(job_id, job, dst, storage)
+    else:
+        await storage.set_state_async(job_id, {
+            "status": "failed",
+            "progress": 0,
+            "message": "Encoding failed",
+        })
 
 
-def probe_duration(path: str) -> Optional[float]:
-    """Probe video duration using ffprobe"""
+async def transcode_split_job(
+    job_id: str,
+    job: VideoConvertJob,
+    storage: StorageBackend,
+    encode_segments: SegmentEncoder,
+    info: dict
+) -> bool:
+    """Encode a long source (see should_split) as segments in parallel
+    
+    Needs no GPU itself. On failure the job is left as is and False is
+    returned, so the caller can retry it with transcode_video.
+    """
+    if not job.request.codec:
+        job.request.codec = RsVideoCodec.AV1
+    
+    print(f"Starting split job {job_id}")
+    dst = storage.get_file_path(job_id, f"output{job.request.format.to_extension()}")
+    streams = info.get("streams", [])
+    if not await transcode_split(job_id, job, job.source.url, dst, streams, storage, encode_segments):
+        return False
+    await complete_job(job_id, job, dst, storage)
+    return True
+
+
+async def complete_job(job_id: str, job: VideoConvertJob, dst: str, storage: StorageBackend):
+    """Publish a finished output"""
+    # Done writing, don't let the output crowd other jobs out of the page cache
+    await asyncio.to_thread(drop_page_cache, dst)
+    
+    # Record first so a client seeing "completed" always finds the file
+    await storage.set_record_async(job_id, {
+        "file_path": dst,
+        "file_name": f"output{job.request.format.to_extension()}",
+        "completed_at": time.time(),
+    })
+    await storage.set_state_async(job_id, {
+        "status": "completed",
+        "progress": 100,
+        "message": "Done",
+    })
+
+
+PIPE_INPUT = "pipe:0"
+DOWNLOAD_CHUNK_SIZE = 8 << 20
+PROGRESS_INTERVAL_S = 0.5
+STDOUT_BUFFER_SIZE = 1 << 20
+# Sources at least this long are split into segments encoded in parallel
+SPLIT_MIN_DURATION_S = 30 * 60
+SEGMENT_TIME_S = 300
+# In-process NVDEC->NVENC through PyNvVideoCodec, opt-in (FFmpeg stays the default)
+PYNV_ENABLED = (
+    importlib.util.find_spec("PyNvVideoCodec") is not None and
+    os.environ.get("TRANSCODE_BACKEND") == "pynv"
+)
+
+
+def drop_page_cache(path: str):
+    """Flush a finished file and advise the kernel to evict its cached pages"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        # Dirty pages can't be dropped, write them back first
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def source_headers(source: RsRequest) -> Dict[str, str]:
+    """Extra HTTP headers required to fetch the source"""
+    headers = dict(source.headers or [])
+    if source.referer:
+        headers["Referer"] = source.referer
+    if source.cookies:
+        headers["Cookie"] = header_value(source.cookies)
+    return headers
+
+
+def headers_option(headers: Optional[Dict[str, str]]) -> list:
+    """FFmpeg/ffprobe -headers option for the given HTTP headers"""
+    if not headers:
+        return []
+    return ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+
+
+def needs_pipe(source: RsRequest) -> bool:
+    """True when FFmpeg's HTTP protocol can't replay the source request itself"""
+    return source.method.upper() != "GET" or source.json_body is not None
+
+
+def input_args(job: VideoConvertJob, src: str) -> list:
+    """FFmpeg input options for src (a URL, local file or PIPE_INPUT)"""
+    if not src.startswith(("http://", "https://")):
+        return ["-i", src]
+    
+    return [
+        "-reconnect", "1",
+        "-reconnect_streamed", "1",
+        "-reconnect_delay_max", "30",
+        *headers_option(source_headers(job.source)),
+        "-i", src,
+    ]
+
+
+# One pooled session per event loop so warm containers reuse TCP+TLS connections
+_http_session: Optional[aiohttp.ClientSession] = None
+_http_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def http_session() -> aiohttp.ClientSession:
+    """Return the shared HTTP session for the running loop"""
+    global _http_session, _http_loop
+    loop = asyncio.get_running_loop()
+    if _http_session is None or _http_session.closed or _http_loop is not loop:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=60),
+            # Socket reads sized like the chunks we hand FFmpeg, not the 64 KiB default
+            read_bufsize=DOWNLOAD_CHUNK_SIZE,
+        )
+        _http_loop = loop
+    return _http_session
+
+
+async def iter_source(source: RsRequest) -> AsyncGenerator[bytes, None]:
+    """Yield the source response body"""
+    async with http_session().request(
+        source.method.upper(),
+        source.url,
+        headers=source_headers(source),
+        json=source.json_body,
+    ) as r:
+        r.raise_for_status()
+        async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            yield chunk
+
+
+async def feed_source(source: RsRequest, proc: asyncio.subprocess.Process):
+    """Pump the source body into FFmpeg's stdin"""
+    stdin = proc.stdin
+    assert stdin is not None
+    try:
+        async with aclosing(iter_source(source)) as chunks:
+            async for chunk in chunks:
+                stdin.write(chunk)
+                await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # FFmpeg exited early, its return code tells what happened
+        pass
+    except Exception:
+        # Don't let FFmpeg finalize a truncated input
+        proc.kill()
+        raise
+    finally:
+        stdin.close()
+
+
+def probe(path: str, headers: Optional[Dict[str, str]] = None) -> dict:
+    """Probe format and streams with one ffprobe run"""
     try:
         out = subprocess.check_output(
             [
                 "ffprobe",
                 "-v", "error",
-                "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1",
+                *headers_option(headers),
+                "-print_format", "json",
+                "-show_format",
+                "-show_streams",
                 path,
             ],
-            text=True,
-        ).strip()
-        return float(out) if out else None
+        )
+        info: dict = json.loads(out)
+        return info
     except Exception:
+        return {}
+
+
+def probed_duration(info: dict) -> Optional[float]:
+    """Container duration in seconds from probe() output"""
+    try:
+        return float(info["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def first_stream(streams: list, codec_type: str) -> Optional[dict]:
+    """First probed stream of the given type (video, audio...)"""
+    return next((s for s in streams if s.get("codec_type") == codec_type), None)
+
+
+# ffprobe codec names for the codecs we can output
+PROBE_CODEC_NAMES = {
+    RsVideoCodec.AV1: "av1",
+    RsVideoCodec.H265: "hevc",
+    RsVideoCodec.H264: "h264",
+}
+
+# NVDEC decoders by ffprobe codec name, keeps decoding on the GPU for every
+# codec it supports instead of silently falling back to the CPU
+CUVID_DECODERS = {
+    "h264": "h264_cuvid",
+    "hevc": "hevc_cuvid",
+    "vp9": "vp9_cuvid",
+    "av1": "av1_cuvid",
+    "mpeg2video": "mpeg2_cuvid",
+}
+
+# Source pixel formats NVDEC decodes for each codec (4:2:0 only, H.264 and
+# MPEG-2 at 8 bits). Anything else (High10, 4:2:2, 4:4:4...) is left to
+# -hwaccel cuda, which falls back to software decoding instead of failing
+_NVDEC_420_8BIT = frozenset(("yuv420p", "yuvj420p", "nv12"))
+_NVDEC_420_10BIT = _NVDEC_420_8BIT | frozenset(("yuv420p10le", "p010le"))
+NVDEC_PIX_FMTS = {
+    "h264": _NVDEC_420_8BIT,
+    "hevc": _NVDEC_420_10BIT,
+    "vp9": _NVDEC_420_10BIT,
+    "av1": _NVDEC_420_10BIT,
+    "mpeg2video": _NVDEC_420_8BIT,
+}
+
+
+def cuvid_decoder(video: Optional[dict]) -> Optional[str]:
+    """NVDEC decoder to pin for the probed video stream, None to let FFmpeg pick"""
+    if not video:
+        return None
+    codec = video.get("codec_name")
+    if not isinstance(codec, str) or video.get("pix_fmt") not in NVDEC_PIX_FMTS.get(codec, ()):
+        return None
+    return CUVID_DECODERS[codec]
+
+# Placeholders spliced into the command templates below
+_SRC = "{src}"
+_CRF = "{crf}"
+_AUDIO = "{audio}"
+_DST = "{dst}"
+_TUNE = "{tune}"
+
+_AAC_AUDIO = ("-c:a", "aac", "-b:a", "192k", "-ar", "48000")
+_COPY_AUDIO = ("-c:a", "copy")
+
+# Pre-rendered quality values (NVENC AV1 QPs go up to 255), avoids formatting ints per job
+_CRF_STR = tuple(str(i) for i in range(256))
+
+# Shared head/tail of every NVENC command, decoded frames stay in VRAM
+_NVENC_INPUT = (
+    "ffmpeg", "-hide_banner", "-nostats", "-y",
+    "-hwaccel", "cuda",
+    "-hwaccel_output_format", "cuda",
+    "-extra_hw_frames", "8",
+    _SRC,
+    "-fps_mode", "passthrough",
+)
+
+_OUTPUT = (
+    _AUDIO,
+    "-movflags", "+faststart",
+    "-progress", "pipe:1",
+    "-stats_period", "0.5",
+    _DST,
+)
+
+
+# 10-bit sources reach NVENC as p010 CUDA frames, no -pix_fmt (it would force a
+# conversion off the GPU), only the bitstream profile is raised
+def _av1_nvenc_args(preset: str, bit_depth: int) -> tuple:
+    return (
+        "-c:v", "av1_nvenc",
+        "-preset", preset,
+        "-tune", _TUNE,
+        "-bf", "3",
+        "-b_ref_mode", "middle",
+        "-refs", "1",
+        "-g", "120",
+        *(("-highbitdepth", "1") if bit_depth > 8 else ()),
+        "-rc", "constqp",
+        "-qp", _CRF,
+    )
+
+
+def _hevc_nvenc_args(preset: str, bit_depth: int) -> tuple:
+    return (
+        "-c:v", "hevc_nvenc",
+        "-preset", preset,
+        "-tune", "hq",
+        "-bf", "4",
+        "-b_ref_mode", "middle",
+        *(("-profile:v", "main10") if bit_depth > 8 else ()),
+        "-rc", "constqp",
+        "-qp", _CRF,
+    )
+
+
+# CPUs this process may run on (cgroup/affinity aware where supported)
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+
+# SVT-AV1 level of parallelism, gains flatten past 8 on shared cloud CPUs
+SVT_LP = min(CPU_COUNT, 8)
+
+# CPU fallback, pinned to the available CPUs. tile-columns is log2, so 1 gives
+# two tile columns (cheap on quality, a little extra parallelism) and no tile
+# rows, lp drives the rest of the parallelism, loop restoration is skipped for speed
+_SVTAV1_TMPL = (
+    "ffmpeg", "-hide_banner", "-nostats", "-y",
+    _SRC,
+    "-c:v", "libsvtav1",
+    "-crf", _CRF,
+    "-preset", "6",
+    "-threads", str(CPU_COUNT),
+    "-svtav1-params", f"fast-decode=1:lp={SVT_LP}:pin=1:tile-columns=1:tile-rows=0:enable-restoration=0",
+    "-pix_fmt", "yuv420p",
+) + _OUTPUT
+
+
+# Source already in the requested codec: remux without decoding
+_REMUX_TMPL = (
+    "ffmpeg", "-hide_banner", "-nostats", "-y",
+    _SRC,
+    "-c:v", "copy",
+) + _OUTPUT
+
+
+@cache
+def av1_nvenc_has_uhq() -> bool:
+    """Whether this FFmpeg build's av1_nvenc offers -tune uhq (checked once)"""
+    try:
+        out = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-h", "encoder=av1_nvenc"],
+            capture_output=True,
+            timeout=10,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return re.search(rb"^\s+uhq\b", out, re.M) is not None
+
+
+def crf_to_nvenc_qp(crf: int, codec: Optional[RsVideoCodec]) -> int:
+    """Map the API's CRF onto NVENC's constant QP scale for codec"""
+    if codec == RsVideoCodec.AV1:
+        # AV1 CRF shares SVT-AV1's 0-63 scale, NVENC AV1 QP is a 0-255 qindex
+        return max(1, min(255, round(crf * 255 / 63)))
+    return max(0, min(51, crf))
+
+
+def resolution_bucket(video: Optional[dict]) -> str:
+    """"hd" up to 1080p, "uhd" above or when the size is unknown"""
+    if not video or not video.get("width") or not video.get("height"):
+        return "uhd"
+    # Portrait sources count by their short side too
+    return "hd" if min(video["width"], video["height"]) <= 1080 else "uhd"
+
+
+def bit_depth(video: Optional[dict]) -> int:
+    """10 for high bit depth sources (yuv420p10le, p010le...), 8 otherwise"""
+    if not video:
+        return 8
+    if str(video.get("bits_per_raw_sample", "")) in ("10", "12"):
+        return 10
+    pix_fmt = video.get("pix_fmt") or ""
+    return 10 if "p10" in pix_fmt or "p12" in pix_fmt or pix_fmt.startswith("p01") else 8
+
+
+def can_remux(job: VideoConvertJob, video: Optional[dict]) -> bool:
+    """Source video is already in the requested codec and no quality was asked for"""
+    return bool(
+        video and job.request.crf is None and
+        video.get("codec_name") == PROBE_CODEC_NAMES.get(job.request.codec or RsVideoCodec.AV1)
+    )
+
+
+def select_gpu(job: VideoConvertJob, info: dict) -> Optional[str]:
+    """Cheapest Modal GPU able to run the job's encode, None for CPU-only work"""
+    video = first_stream(info.get("streams", []), "video")
+    codec = job.request.codec or RsVideoCodec.AV1
+    if can_remux(job, video) or (codec, "uhd", 8) not in PROFILES:
         return None
+    if codec == RsVideoCodec.AV1:
+        # Only Ada (L4) has an AV1 encoder, T4 (Turing) and A10G (Ampere) don't
+        return "L4"
+    # HEVC: T4 keeps up with 1080p, bigger (or unprobed) sources get an A10G.
+    # Turing's NVDEC has no AV1 decoder, those sources need Ampere
+    if video and video.get("codec_name") == "av1":
+        return "A10G"
+    return "T4" if resolution_bucket(video) == "hd" else "A10G"
+
+
+def should_split(job: VideoConvertJob, info: dict) -> bool:
+    """Whether a probed source is long enough to encode as parallel segments"""
+    duration_s = probed_duration(info)
+    return bool(
+        not needs_pipe(job.source) and
+        duration_s and duration_s >= SPLIT_MIN_DURATION_S and
+        not can_remux(job, first_stream(info.get("streams", []), "video"))
+    )
+
+
+def audio_codec_args(audio: Optional[dict]) -> tuple:
+    """Audio codec options for the probed audio stream"""
+    # AAC at 48 kHz is what we would encode anyway, copy it untouched
+    if audio and audio.get("codec_name") == "aac" and audio.get("sample_rate") == "48000":
+        return _COPY_AUDIO
+    return _AAC_AUDIO
+
+
+def _compile_template(tmpl: tuple, default_crf: Optional[int]) -> tuple:
+    """Resolve placeholder positions once at import time"""
+    i_crf = tmpl.index(_CRF) if _CRF in tmpl else None
+    i_tune = tmpl.index(_TUNE) if _TUNE in tmpl else None
+    return tmpl, tmpl.index(_SRC), i_crf, tmpl.index(_AUDIO), tmpl.index(_DST), default_crf, i_tune
+
+
+# NVENC profiles by (codec, resolution bucket, bit depth): slower presets where
+# the frame rate leaves headroom, the faster p4 for UHD (and unprobed) sources
+NVENC_DEFAULT_CRF = {
+    RsVideoCodec.AV1: 32,
+    RsVideoCodec.H265: 28,
+}
+
+PROFILES = {
+    (codec, bucket, depth): _compile_template(
+        _NVENC_INPUT + args(preset, depth) + _OUTPUT, NVENC_DEFAULT_CRF[codec]
+    )
+    for codec, args in (
+        (RsVideoCodec.AV1, _av1_nvenc_args),
+        (RsVideoCodec.H265, _hevc_nvenc_args),
+    )
+    for bucket, preset in (("hd", "p6"), ("uhd", "p4"))
+    for depth in (8, 10)
+}
+
+_SVTAV1 = _compile_template(_SVTAV1_TMPL, 32)
+_SVTAV1_10BIT = _compile_template(
+    tuple("yuv420p10le" if a == "yuv420p" else a for a in _SVTAV1_TMPL), 32
+)
+_REMUX = _compile_template(_REMUX_TMPL, None)
 
 
 def build_ffmpeg_command(
     job: VideoConvertJob,
     src: str,
     dst: str,
-    use_gpu: bool
+    use_gpu: bool,
+    streams: Optional[list] = None,
+    uhq: bool = False
 ) -> list:
-    """Build FFmpeg command based on job configuration"""
+    """Build FFmpeg command based on job configuration and probed streams
     
-    if use_gpu and job.request.codec == RsVideoCodec.AV1:
-        return [
-            "ffmpeg", "-hide_banner", "-nostats", "-y",
-            "-hwaccel", "cuda",
-            "-hwaccel_output_format", "cuda",
-            "-i", src,
-            "-c:v", "av1_nvenc",
-            "-preset", "p4",
-            "-cq", str(job.request.crf or 32),
-            "-b:v", "0",
-            "-c:a", "aac",
-            "-b:a", "192k",
-            "-ar", "48000",
-            "-movflags", "+faststart",
-            "-progress", "pipe:1",
-            dst,
-        ]
-    elif use_gpu and job.request.codec == RsVideoCodec.H265:
-        return [
-            "ffmpeg", "-hide_banner", "-nostats", "-y",
-            "-hwaccel", "cuda",
-            "-hwaccel_output_format", "cuda",
-            "-i", src,
-            "-c:v", "hevc_nvenc",
-            "-preset", "p4",
-            "-cq", str(job.request.crf or 28),
-            "-b:v", "0",
-            "-c:a", "aac",
-            "-b:a", "192k",
-            "-ar", "48000",
-            "-movflags", "+faststart",
-            "-progress", "pipe:1",
-            dst,
-        ]
+    uhq selects av1_nvenc's -tune uhq, see av1_nvenc_has_uhq.
+    """
+    
+    video = first_stream(streams or [], "video")
+    audio = first_stream(streams or [], "audio")
+    codec = job.request.codec or RsVideoCodec.AV1
+    
+    decoder_args: tuple = ()
+    nvenc = False
+    if can_remux(job, video):
+        tmpl, i_src, i_crf, i_audio, i_dst, default_crf, i_tune = _REMUX
+    elif use_gpu and (codec, "uhd", 8) in PROFILES:
+        profile = PROFILES[codec, resolution_bucket(video), bit_depth(video)]
+        tmpl, i_src, i_crf, i_audio, i_dst, default_crf, i_tune = profile
+        nvenc = True
+        decoder = cuvid_decoder(video)
+        if decoder:
+            decoder_args = ("-c:v", decoder)
+    elif bit_depth(video) > 8:
+        tmpl, i_src, i_crf, i_audio, i_dst, default_crf, i_tune = _SVTAV1_10BIT
     else:
-        # CPU fallback
-        return [
-            "ffmpeg", "-hide_banner", "-nostats", "-y",
-            "-i", src,
-            "-c:v", "libsvtav1",
-            "-crf", str(job.request.crf or 32),
-            "-preset", "6",
-            "-pix_fmt", "yuv420p",
-            "-c:a", "aac",
-            "-b:a", "192k",
-            "-ar", "48000",
-            "-movflags", "+faststart",
-            "-progress", "pipe:1",
-            dst,
-        ]
+        tmpl, i_src, i_crf, i_audio, i_dst, default_crf, i_tune = _SVTAV1
+    
+    audio_args = audio_codec_args(audio)
+    
+    # Fill from the right so earlier placeholder indexes stay valid
+    cmd = list(tmpl)
+    cmd[i_dst] = dst
+    cmd[i_audio:i_audio + 1] = audio_args
+    if i_crf is not None:
+        crf = job.request.crf or default_crf
+        if nvenc:
+            crf = crf_to_nvenc_qp(crf, codec)
+        cmd[i_crf] = _CRF_STR[crf] if 0 <= crf < len(_CRF_STR) else str(crf)
+    if i_tune is not None:
+        cmd[i_tune] = "uhq" if uhq else "hq"
+    cmd[i_src:i_src + 1] = [*decoder_args, *input_args(job, src)]
+    return cmd
+
 
+# -progress blocks end with "progress=continue|end", out_time_us is in microseconds
+# (out_time_ms is too, despite its name)
+_PROGRESS_RE = re.compile(rb"^out_time_us=(\d+)$", re.M)
+_PROGRESS_END = b"progress=end"
+# Input banner, the only duration source for unprobed (piped) input
+_DURATION_RE = re.compile(rb"Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)")
 
-def run_ffmpeg_with_progress(
+
+def kill_process_group(proc: asyncio.subprocess.Process):
+    """Kill FFmpeg's session (it and any helpers) if it's still running"""
+    if proc.returncode is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+async def run_ffmpeg_with_progress(
     cmd: list,
     duration_s: Optional[float],
     job_id: str,
-    storage: StorageBackend
+    storage: StorageBackend,
+    source: Optional[RsRequest] = None
 ) -> bool:
-    """Run FFmpeg and track progress"""
-    
-    proc = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
+    """Run FFmpeg and track progress, feeding source to its stdin if given"""
+    
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if source else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=STDOUT_BUFFER_SIZE,
+        start_new_session=True,
     )
+    feeder = asyncio.create_task(feed_source(source, proc)) if source else None
     
-    last_emit = time.time()
-    pct = 0
+    out_time_us = 0
+    done = asyncio.Event()
+    
+    # Background writer: the reader only records the latest timestamp, percentages
+    # and storage RPCs happen here at 2 Hz so a slow write never
+    # stalls draining FFmpeg's stdout
+    async def flush_progress():
+        # One snapshot reused for every write, backends serialize it before returning.
+        # The caller already stored 0% when encoding started
+        snapshot = {"status": "encoding", "progress": 0, "message": "Encoding in progress"}
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), PROGRESS_INTERVAL_S)
+            except TimeoutError:
+                pass
+            if not duration_s or duration_s <= 0:
+                continue
+            pct = min(99, int(out_time_us / (duration_s * 1_000_000) * 100))
+            if pct != snapshot["progress"] and not done.is_set():
+                snapshot["progress"] = pct
+                try:
+                    await storage.set_state_async(job_id, snapshot)
+                except Exception as e:
+                    print(f"Progress update failed: {e}")
+    
+    flusher = asyncio.create_task(flush_progress())
     
     try:
         stdout = proc.stdout
         if stdout is None:
             # No stdout to iterate (shouldn't happen when stdout=PIPE), wait for process and return result.
-            ret = proc.wait()
+            ret = await proc.wait()
             return ret == 0
-
-        for line in stdout:
-            line = line.strip()
+        
+        # Parse whole buffers at once, only complete lines are scanned. The
+        # partial trailing line is carried in place in a bytearray, no decoding
+        pending = bytearray()
+        while True:
+            chunk = await stdout.read(STDOUT_BUFFER_SIZE)
+            if not chunk:
+                break
             
-            if line.startswith("out_time_ms="):
-                try:
-                    out_time_ms = float(line.split("=", 1)[1])
-                    if duration_s and duration_s > 0:
-                        pct = min(99, int((out_time_ms / (duration_s * 1000.0)) * 100))
-                except Exception:
-                    pass
+            cut = chunk.rfind(b"\n") + 1
+            if not cut:
+                pending += chunk
+                continue
+            if pending:
+                pending += chunk[:cut]
+                block = bytes(pending)
+                pending.clear()
+            else:
+                block = chunk[:cut]
+            pending += chunk[cut:]
+            
+            if duration_s is None:
+                m = _DURATION_RE.search(block)
+                if m:
+                    h, mins, secs = m.groups()
+                    duration_s = int(h) * 3600 + int(mins) * 60 + float(secs)
+            
+            last = None
+            for last in _PROGRESS_RE.finditer(block):
+                pass
+            if last:
+                out_time_us = int(last.group(1))
             
-            # Update progress periodically
-            now = time.time()
-            if now - last_emit > 0.5:
-                storage.set_state(job_id, {
-                    "status": "encoding",
-                    "progress": pct,
-                    "message": "Encoding in progress",
-                })
-                last_emit = now
+            # Final block written, no need to wait for EOF
+            if _PROGRESS_END in block:
+                break
         
-        ret = proc.wait()
+        ret = await proc.wait()
+        if feeder:
+            await feeder
         return ret == 0
     except Exception as e:
         print(f"Error during encoding: {e}")
         return False
+    finally:
+        # Let an in-flight write land before the caller stores the final state
+        done.set()
+        await flusher
+        if feeder and not feeder.done():
+            feeder.cancel()
+        kill_process_group(proc)
+
+
+async def run_ffmpeg(cmd: list) -> bool:
+    """Run an FFmpeg command to completion, output discarded"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    try:
+        _, err = await proc.communicate()
+    finally:
+        kill_process_group(proc)
+    if proc.returncode != 0:
+        print(err.decode(errors="replace")[-2000:])
+    return proc.returncode == 0
+
+
+async def transcode_segment(
+    job: VideoConvertJob,
+    src: str,
+    dst: str,
+    use_gpu: bool,
+    streams: list
+) -> bool:
+    """Encode one video-only segment of a split job"""
+    uhq = use_gpu and await asyncio.to_thread(av1_nvenc_has_uhq)
+    return await run_ffmpeg(build_ffmpeg_command(job, src, dst, use_gpu, streams, uhq))
+
+
+async def transcode_split(
+    job_id: str,
+    job: VideoConvertJob,
+    src: str,
+    dst: str,
+    streams: list,
+    storage: StorageBackend,
+    encode_segments: SegmentEncoder
+) -> bool:
+    """Split the source at keyframes, encode the segments in parallel and join them"""
+    work_dir = os.path.join(os.path.dirname(dst), "segments")
+    os.makedirs(work_dir, exist_ok=True)
+    audio = first_stream(streams, "audio")
+    audio_path = os.path.join(work_dir, "audio.mka")
+    
+    await storage.set_state_async(job_id, {
+        "status": "encoding",
+        "progress": 0,
+        "message": "Splitting source",
+    })
+    
+    try:
+        # One read of the source: video cut into segments, audio kept whole
+        split_cmd = [
+            "ffmpeg", "-hide_banner", "-nostats", "-y",
+            *input_args(job, src),
+            "-map", "0:v:0",
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_time", str(SEGMENT_TIME_S),
+            "-reset_timestamps", "1",
+            os.path.join(work_dir, "chunk_%04d.mkv"),
+        ]
+        if audio:
+            split_cmd += ["-map", "0:a:0", "-c", "copy", audio_path]
+        if not await run_ffmpeg(split_cmd):
+            return False
+        
+        chunks = sorted(e.path for e in os.scandir(work_dir) if e.name.startswith("chunk_"))
+        pairs = [(chunk, chunk[:-4] + ".enc.mp4") for chunk in chunks]
+        print(f"Encoding {len(pairs)} segments in parallel")
+        
+        # Segments finish out of order, progress is the share done so far.
+        # After a failure keep draining so no worker writes into work_dir
+        # once it has been removed.
+        done = 0
+        failed = False
+        async for ok in encode_segments(job, pairs, streams):
+            if not ok:
+                failed = True
+            if failed:
+                continue
+            done += 1
+            await storage.set_state_async(job_id, {
+                "status": "encoding",
+                "progress": min(99, done * 100 // len(pairs)),
+                "message": f"Encoded {done}/{len(pairs)} segments",
+            })
+        if failed:
+            return False
+        
+        list_path = os.path.join(work_dir, "list.txt")
+        with open(list_path, "w") as f:
+            f.writelines(f"file '{out}'\n" for _, out in pairs)
+        
+        concat_cmd = [
+            "ffmpeg", "-hide_banner", "-nostats", "-y",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+        ]
+        if audio:
+            concat_cmd += ["-i", audio_path, "-map", "0:v", "-map", "1:a", *audio_codec_args(audio)]
+        concat_cmd += ["-c:v", "copy", "-movflags", "+faststart", dst]
+        return await run_ffmpeg(concat_cmd)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# PyNvVideoCodec encoder names and the FFmpeg raw demuxer for their bitstream
+PYNV_CODECS = {
+    RsVideoCodec.AV1: ("av1", "obu"),
+    RsVideoCodec.H265: ("hevc", "hevc"),
+}
+
+
+# NVDEC output surface formats and the NVENC input format with the same layout
+# (P016 carries 10-bit samples in the high bits, like P010)
+PYNV_ENCODER_FORMATS = {
+    "NV12": "NV12",
+    "P016": "P010",
+    "YUV444": "YUV444",
+    "YUV444_16Bit": "YUV444_16BIT",
+}
+
+
+def can_use_pynv(job: VideoConvertJob, src: str, streams: list) -> bool:
+    """Whether the in-process PyNvVideoCodec path can handle this job"""
+    video = first_stream(streams, "video")
+    if not PYNV_ENABLED or video is None:
+        return False
+    return bool(
+        cuvid_decoder(video) is not None and
+        video.get("avg_frame_rate", "0/0") != "0/0" and
+        # The raw bitstream is re-timed at a fixed rate on mux, variable frame
+        # rate sources would drift against the audio
+        video.get("r_frame_rate") == video.get("avg_frame_rate") and
+        job.request.codec in PYNV_CODECS and
+        not can_remux(job, video) and
+        src != PIPE_INPUT and
+        # Only the video and first audio stream are carried over, like the
+        # FFmpeg path's default stream selection
+        len(streams) == 1 + (first_stream(streams, "audio") is not None)
+    )
+
+
+def encode_pynv(src: str, raw_path: str, config: dict, on_frame: Callable[[int], None]):
+    """Decode with NVDEC and encode with NVENC in-process, writing the raw bitstream"""
+    import PyNvVideoCodec
+    
+    demuxer = PyNvVideoCodec.CreateDemuxer(filename=src)
+    decoder = PyNvVideoCodec.CreateDecoder(
+        gpuid=0, codec=demuxer.GetNvCodecId(), cudacontext=0, cudastream=0, usedevicememory=True
+    )
+    encoder = None
+    
+    frames = 0
+    with open(raw_path, "wb") as out:
+        for packet in demuxer:
+            for frame in decoder.Decode(packet):
+                if encoder is None:
+                    # Feed NVENC the surface layout NVDEC actually produced
+                    surface = frame.format.name
+                    if surface not in PYNV_ENCODER_FORMATS:
+                        raise ValueError(f"Unsupported decoder output format {surface}")
+                    encoder = PyNvVideoCodec.CreateEncoder(
+                        demuxer.Width(), demuxer.Height(), PYNV_ENCODER_FORMATS[surface], False, **config
+                    )
+                out.write(bytearray(encoder.Encode(frame)))
+                frames += 1
+                on_frame(frames)
+        if encoder is not None:
+            out.write(bytearray(encoder.EndEncode()))
+
+
+async def transcode_pynv(
+    job_id: str,
+    job: VideoConvertJob,
+    src: str,
+    dst: str,
+    streams: list,
+    duration_s: Optional[float],
+    storage: StorageBackend
+) -> bool:
+    """Encode the video in-process, then mux it with the source audio"""
+    video = first_stream(streams, "video") or {}
+    audio = first_stream(streams, "audio")
+    target = job.request.codec or RsVideoCodec.AV1
+    codec, raw_format = PYNV_CODECS[target]
+    fps = video["avg_frame_rate"]
+    num, _, den = fps.partition("/")
+    total_frames = (duration_s or 0) * int(num) / int(den or 1)
+    
+    # Same default quality as the FFmpeg NVENC profiles
+    crf = job.request.crf or NVENC_DEFAULT_CRF[target]
+    config = {
+        "codec": codec,
+        "preset": "P6" if resolution_bucket(video) == "hd" else "P4",
+        "tuning_info": "high_quality",
+        "rc": "constqp",
+        "constqp": crf_to_nvenc_qp(crf, target),
+        "bf": 3,
+        "gop": 120,
+    }
+    raw_path = f"{dst}.{raw_format}"
+    video_path = f"{dst}.video.mkv"
+    audio_path = f"{dst}.audio.mka"
+    
+    await storage.set_state_async(job_id, {
+        "status": "downloading",
+        "progress": 0,
+        "message": "Downloading source",
+    })
+    
+    # Frame callbacks run on the encode thread and only record the count, storage
+    # writes happen on the event loop at 2 Hz so they never stall NVENC
+    frames_done = 0
+    done = asyncio.Event()
+    
+    def on_frame(frames: int):
+        nonlocal frames_done
+        frames_done = frames
+    
+    async def flush_progress():
+        snapshot = {"status": "encoding", "progress": 0, "message": "Encoding in progress"}
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), PROGRESS_INTERVAL_S)
+            except TimeoutError:
+                pass
+            if total_frames <= 0:
+                continue
+            pct = min(99, int(frames_done * 100 / total_frames))
+            if pct != snapshot["progress"] and not done.is_set():
+                snapshot["progress"] = pct
+                try:
+                    await storage.set_state_async(job_id, snapshot)
+                except Exception as e:
+                    print(f"Progress update failed: {e}")
+    
+    try:
+        # One read of the source: video for the decoder, audio kept for the mux
+        split_cmd = [
+            "ffmpeg", "-hide_banner", "-nostats", "-y",
+            *input_args(job, src),
+            "-map", "0:v:0", "-c", "copy", video_path,
+        ]
+        if audio:
+            split_cmd += ["-map", "0:a:0", "-c", "copy", audio_path]
+        if not await run_ffmpeg(split_cmd):
+            return False
+        
+        await storage.set_state_async(job_id, {
+            "status": "encoding",
+            "progress": 0,
+            "message": "Encoding started",
+        })
+        flusher = asyncio.create_task(flush_progress())
+        try:
+            await asyncio.to_thread(encode_pynv, video_path, raw_path, config, on_frame)
+        except Exception as e:
+            print(f"PyNvVideoCodec error: {e}")
+            return False
+        finally:
+            done.set()
+            await flusher
+        
+        # The raw bitstream has no timestamps, restore them from the probed rate
+        mux_cmd = [
+            "ffmpeg", "-hide_banner", "-nostats", "-y",
+            "-framerate", fps, "-f", raw_format, "-i", raw_path,
+        ]
+        if audio:
+            mux_cmd += ["-i", audio_path, "-map", "0:v", "-map", "1:a", *audio_codec_args(audio)]
+        mux_cmd += ["-c:v", "copy", "-movflags", "+faststart", dst]
+        return await run_ffmpeg(mux_cmd)
+    finally:
+        for path in (raw_path, video_path, audio_path):
+            if os.path.exists(path):
+                os.remove(path)
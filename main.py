@@ -1,8 +1,12 @@
 # main.py
 """Modal deployment entry point"""
+import asyncio
 import modal
 from core.storage import ModalStorage
-from core.worker import transcode_video
+from core.worker import (
+    transcode_video, transcode_split_job, transcode_segment, probe, select_gpu, should_split,
+    needs_pipe, source_headers
+)
 from core.api import create_app
 
 # Modal resources
@@ -12,75 +16,195 @@ image = (
         add_python="3.12"
     )
     .dockerfile_commands("ENTRYPOINT []")
-    .pip_install("fastapi[standard]", "requests", "rs-common-interfaces-py==0.1.2")
+    .pip_install("fastapi[standard]", "aiohttp", "orjson", "rs-common-interfaces-py==0.1.2")
+    # Optional in-process backend, enabled with TRANSCODE_BACKEND=pynv
+    .pip_install("PyNvVideoCodec")
     .add_local_python_source("core")
 )
 
 out_vol = modal.Volume.from_name("av1-output", create_if_missing=True)
 progress_kv = modal.Dict.from_name("av1-progress", create_if_missing=True)
+progress_q = modal.Queue.from_name("av1-progress-events", create_if_missing=True)
+pending_kv = modal.Dict.from_name("av1-pending", create_if_missing=True)
 
 app = modal.App("av1-background-converter", image=image)
 
 # Create storage backend for Modal
-storage = ModalStorage(progress_kv, out_vol)
+storage = ModalStorage(progress_kv, out_vol, queue_obj=progress_q, pending_obj=pending_kv)
+
+# Worker functions (Modal-decorated), identical except for the GPU they run on
+WORKER_TIMEOUT = 60 * 60 * 2
+
+# One warm L4 skips the GPU cold start, and its two NVENC engines encode
+# independently so each container takes two jobs
+@app.function(
+    image=image,
+    gpu="L4",
+    cpu=8,
+    min_containers=1,
+    volumes={"/vol": out_vol},
+    timeout=WORKER_TIMEOUT,
+)
+@modal.concurrent(max_inputs=2)
+async def transcode_worker(job_id: str, job, info=None):
+    """Modal worker wrapper (AV1 NVENC needs an L4)"""
+    await transcode_video(job_id, job, storage, use_gpu=True, info=info)
+
+@app.function(
+    image=image,
+    gpu="A10G",
+    cpu=8,
+    volumes={"/vol": out_vol},
+    timeout=WORKER_TIMEOUT,
+)
+async def transcode_a10g(job_id: str, job, info=None):
+    """Modal worker for HEVC above 1080p"""
+    await transcode_video(job_id, job, storage, use_gpu=True, info=info)
+
+@app.function(
+    image=image,
+    gpu="T4",
+    cpu=8,
+    volumes={"/vol": out_vol},
+    timeout=WORKER_TIMEOUT,
+)
+async def transcode_t4(job_id: str, job, info=None):
+    """Modal worker for HEVC up to 1080p"""
+    await transcode_video(job_id, job, storage, use_gpu=True, info=info)
 
-# Worker function (Modal-decorated)
+@app.function(
+    image=image,
+    cpu=8,
+    volumes={"/vol": out_vol},
+    timeout=WORKER_TIMEOUT,
+)
+async def transcode_cpu(job_id: str, job, info=None):
+    """Modal worker for remuxes and SVT-AV1 encodes"""
+    await transcode_video(job_id, job, storage, use_gpu=False, info=info)
+
+GPU_WORKERS = {
+    "L4": transcode_worker,
+    "A10G": transcode_a10g,
+    "T4": transcode_t4,
+    None: transcode_cpu,
+}
+
+# Probes the source on a small container, then spawns the right-sized worker.
+# Every job passes through here, so one container is kept warm (and takes many
+# probes at once) or its cold start would sit in front of the warm L4
+@app.function(image=image, cpu=0.25, min_containers=1, timeout=60 * 5)
+@modal.concurrent(max_inputs=50)
+async def dispatch(job_id: str, job):
+    """Route a job to the cheapest worker able to encode it"""
+    info = {}
+    if not needs_pipe(job.source):
+        info = await asyncio.to_thread(probe, job.source.url, source_headers(job.source))
+    gpu = select_gpu(job, info)
+    if gpu == "L4" and should_split(job, info):
+        print(f"Dispatching job {job_id} to the split orchestrator")
+        await transcode_split_worker.spawn.aio(job_id, job, info)
+        return
+    print(f"Dispatching job {job_id} to {gpu or 'CPU'}")
+    # A failed (empty) probe is left for the worker to retry
+    await GPU_WORKERS[gpu].spawn.aio(job_id, job, info or None)
+
+# Long sources: split, fan out and join on a small CPU container, so no GPU
+# sits idle while the segments encode
+@app.function(
+    image=image,
+    cpu=2,
+    volumes={"/vol": out_vol},
+    timeout=WORKER_TIMEOUT,
+)
+async def transcode_split_worker(job_id: str, job, info):
+    """Encode a long source as parallel L4 segments"""
+    try:
+        ok = await transcode_split_job(job_id, job, storage, encode_segments, info)
+    except Exception as e:
+        print(f"Split encode error: {e}")
+        ok = False
+    if not ok:
+        print(f"Split encode of {job_id} failed, retrying in a single pass")
+        await transcode_worker.spawn.aio(job_id, job, info)
+
+# Segment worker for long sources, one GPU per segment
 @app.function(
     image=image,
     gpu="L4",
+    cpu=8,
     volumes={"/vol": out_vol},
-    timeout=60 * 60 * 2,
+    timeout=60 * 60,
 )
-def transcode_worker(job_id: str, job):
-    """Modal worker wrapper"""
-    transcode_video(job_id, job, storage, use_gpu=True)
+async def transcode_segment_worker(job, src: str, dst: str, streams: list) -> bool:
+    """Encode one segment written to the volume by transcode_split_worker"""
+    await out_vol.reload.aio()
+    ok = await transcode_segment(job, src, dst, True, streams)
+    await out_vol.commit.aio()
+    return ok
+
+async def encode_segments(job, pairs, streams):
+    """Fan segments out to transcode_segment_worker, yielding results as they finish"""
+    # Segment workers must see the chunks, and we must see their outputs
+    await out_vol.commit.aio()
+    async for ok in transcode_segment_worker.starmap.aio(
+        [(job, src, dst, streams) for src, dst in pairs],
+        order_outputs=False,
+        return_exceptions=True,
+    ):
+        # A crashed worker counts as a failed segment, the rest still drain
+        yield ok is True
+    await out_vol.reload.aio()
 
 # Cleanup job
 @app.function(
     image=image,
     volumes={"/vol": out_vol},
-    schedule=modal.Period(hours=6),
+    schedule=modal.Period(hours=1),
     timeout=60 * 10,
 )
-def cleanup_old_files():
-    """Delete old undownloaded files"""
+async def cleanup_old_files():
+    """Delete downloaded files and old undownloaded ones"""
     import time
     
     RETENTION_HOURS = 24
-    cutoff_time = time.time() - (RETENTION_HOURS * 3600)
-    deleted_count = 0
+    # Downloaded files stay a little longer so interrupted transfers can resume
+    DOWNLOADED_GRACE_HOURS = 1
+    now = time.time()
+    cutoff_time = now - (RETENTION_HOURS * 3600)
+    downloaded_cutoff = now - (DOWNLOADED_GRACE_HOURS * 3600)
+    updates = {}
     
-    for job_id in storage.list_jobs():
-        data = storage.get_state(job_id)
-        if not data:
-            continue
-        
-        status = data.get("status")
+    # No-op once jobs from before the job:/prog: key split have been moved
+    await storage.migrate()
+    
+    # Only completed jobs with a file still on the volume are indexed
+    async for job_id, data in storage.iter_pending():
         created_at = data.get("created_at", 0)
-        downloaded = data.get("downloaded", False)
-        already_deleted = data.get("deleted", False)
+        downloaded_at = data.get("downloaded_at") if data.get("downloaded") else None
         
-        if (status == "completed" and not downloaded and
-            not already_deleted and created_at < cutoff_time):
-            file_path = data.get("file_path")
-            if file_path and storage.file_exists(file_path):
-                storage.delete_file(file_path)
-                data["deleted"] = True
-                data["deleted_at"] = time.time()
-                storage.set_state(job_id, data)
-                deleted_count += 1
+        if created_at < cutoff_time or (downloaded_at is not None and downloaded_at < downloaded_cutoff):
+            # Flag it even if the file is already gone so it leaves the index
+            data["deleted"] = True
+            data["deleted_at"] = time.time()
+            updates[job_id] = data
+    
+    # Deletes are I/O bound, run them side by side on the default thread pool
+    paths = [data["file_path"] for data in updates.values() if data.get("file_path")]
+    await asyncio.gather(*(asyncio.to_thread(storage.delete_file, path) for path in paths))
     
+    await storage.set_records(updates)
     storage.commit()
-    print(f"Cleanup complete. Deleted {deleted_count} files.")
+    print(f"Cleanup complete. Deleted {len(updates)} files.")
 
 # Create and expose FastAPI app
 def worker_func(job_id, job):
     """Wrapper that spawns Modal function"""
-    transcode_worker.spawn(job_id, job)
+    dispatch.spawn(job_id, job)
 
 api = create_app(storage, worker_func)
 
 @app.function(image=image, volumes={"/vol": out_vol})
+@modal.concurrent(max_inputs=1000)
 @modal.asgi_app()
 def fastapi_app():
     return api
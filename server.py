@@ -1,7 +1,9 @@
 # local_server.py
 """Local development server"""
 import uvicorn
-import threading
+import asyncio
+import socket
+from typing import Set
 from core.storage import LocalStorage
 from core.worker import transcode_video
 from core.api import create_app
@@ -9,21 +11,36 @@ from core.api import create_app
 # Create local storage
 storage = LocalStorage(base_dir="./local_data")
 
-# Worker runs in background thread locally
+# Keep references so running jobs aren't garbage collected
+_tasks: Set[asyncio.Task] = set()
+
+# Worker runs as a background task on the server event loop locally
 def worker_func(job_id, job):
-    """Run worker in background thread"""
-    thread = threading.Thread(
-        target=transcode_video,
-        args=(job_id, job, storage),
-        kwargs={"use_gpu": False},  # Set to True if you have local GPU
-        daemon=True
+    """Schedule worker on the running event loop"""
+    task = asyncio.get_running_loop().create_task(
+        transcode_video(job_id, job, storage, use_gpu=False)  # Set to True if you have local GPU
     )
-    thread.start()
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
 
 # Create FastAPI app
 app = create_app(storage, worker_func)
 
+# Large send buffer so multi-GB downloads aren't capped by the kernel window
+SEND_BUFFER_BYTES = 4 * 1024 * 1024
+BACKLOG = 2048
+
+def make_socket(host: str, port: int) -> socket.socket:
+    """Bind the listening socket; accepted connections inherit SO_SNDBUF"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+    sock.bind((host, port))
+    sock.listen(BACKLOG)
+    return sock
+
 if __name__ == "__main__":
     print("Starting local server on http://localhost:8000")
     print("Data stored in ./local_data")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    config = uvicorn.Config(app, http="h11", backlog=BACKLOG)
+    uvicorn.Server(config).run(sockets=[make_socket("0.0.0.0", 8000)])
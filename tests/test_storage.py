@@ -0,0 +1,117 @@
+"""ModalStorage against in-memory stand-ins for modal.Dict and modal.Queue"""
+import asyncio
+import queue
+import time
+import unittest
+from typing import Optional
+
+from core.storage import ModalStorage
+
+
+class _Method:
+    """Callable with an .aio variant, like Modal object methods"""
+    
+    def __init__(self, fn):
+        self.fn = fn
+    
+    def __call__(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+    
+    async def aio(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+
+class FakeDict:
+    def __init__(self):
+        self.data = {}
+        self.get = _Method(lambda key, default=None: self.data.get(key, default))
+        self.put = _Method(self.data.__setitem__)
+        self.pop = _Method(self.data.pop)
+        self.update = _Method(self.data.update)
+    
+    def __setitem__(self, key, value):
+        self.data[key] = value
+    
+    def keys(self):
+        return list(self.data)
+
+
+class FakeQueue:
+    def __init__(self):
+        self.partitions = {}
+        self.put = _Method(self._put)
+        self.clear = _Method(lambda partition=None: self.partitions.pop(partition, None))
+        self.get_many = _Method(None)
+        self.get_many.aio = self._get_many
+    
+    def _put(self, item, block=True, partition=None):
+        self.partitions.setdefault(partition, []).append(item)
+    
+    async def _get_many(self, n, partition=None, timeout=None):
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            items = self.partitions.get(partition)
+            if items:
+                taken, self.partitions[partition] = items[:n], items[n:]
+                return taken
+            if time.monotonic() >= deadline:
+                raise queue.Empty
+            await asyncio.sleep(0.01)
+
+
+class ModalStorageWatchTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # API and worker containers: separate instances, shared Dict and Queue
+        self.dict = FakeDict()
+        self.queue = FakeQueue()
+        self.api = ModalStorage(self.dict, None, queue_obj=self.queue)
+        self.worker = ModalStorage(self.dict, None, queue_obj=self.queue)
+        self.api.WATCH_TIMEOUT = 10
+        self.api.WATCH_POLL_S = 10
+        self.worker.set_record("job", {"file_name": "output.mp4"})
+        self.worker.set_state("job", {"status": "encoding", "progress": 0})
+    
+    async def collect(self, job_id: str, storage: Optional[ModalStorage] = None) -> list:
+        updates = []
+        async for data in (storage or self.api).watch(job_id):
+            if data is not None:
+                updates.append(data)
+                if data["status"] == "completed":
+                    break
+        return updates
+    
+    async def test_update_right_after_a_read_is_not_served_from_cache(self):
+        watcher = asyncio.create_task(self.collect("job"))
+        await asyncio.sleep(0.1)
+        self.worker.set_state("job", {"status": "completed", "progress": 100})
+        
+        updates = await asyncio.wait_for(watcher, 2)
+        self.assertEqual(updates[-1], {"file_name": "output.mp4", "status": "completed", "progress": 100})
+    
+    async def test_every_watcher_sees_every_update(self):
+        watchers = [asyncio.create_task(self.collect("job")) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        self.worker.set_state("job", {"status": "encoding", "progress": 50})
+        await asyncio.sleep(0.1)
+        self.worker.set_state("job", {"status": "completed", "progress": 100})
+        
+        for updates in await asyncio.wait_for(asyncio.gather(*watchers), 2):
+            self.assertEqual([data["progress"] for data in updates], [0, 50, 100])
+        await asyncio.sleep(0)
+        self.assertEqual(self.api._feeds, {})
+
+    
+    async def test_pushes_taken_by_another_container_are_polled(self):
+        other = ModalStorage(self.dict, None, queue_obj=self.queue)
+        for storage in (self.api, other):
+            storage.WATCH_POLL_S = 0.2
+        watchers = [asyncio.create_task(self.collect("job", storage)) for storage in (self.api, other)]
+        await asyncio.sleep(0.1)
+        self.worker.set_state("job", {"status": "completed", "progress": 100})
+        
+        for updates in await asyncio.wait_for(asyncio.gather(*watchers), 2):
+            self.assertEqual(updates[-1]["status"], "completed")
+
+
+if __name__ == "__main__":
+    unittest.main()